@@ -0,0 +1,134 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+from pathlib import Path
+
+from generate_pickle_data import load_glove_emb, load_w2v_emb, load_fasttext_emb
+from reorder_data import write_matrix
+
+SCRIPT_PATH = Path(os.path.dirname(os.path.realpath(__file__)))
+
+DELTA_SECTIONS = ('added', 'replaced', 'removed')
+MATRIX_SUFFIXES = ('.npy', '.vocab')
+
+
+def load_pickle(path):
+    print("Loading file: {}".format(path))
+    with path.open('rb') as pkl_file:
+        return pickle.load(pkl_file)
+
+
+def save_pickle(data, path):
+    print("Saving file: {}".format(path))
+    with path.open('wb') as pkl_file:
+        pickle.dump(data, pkl_file)
+
+
+def load_matrix(path):
+    """Returns the rows of a matrix written by reorder_data.py, by word in
+    row order"""
+    vocab = load_pickle(path.with_suffix(".vocab"))
+    matrix = np.load(str(path.with_suffix(".npy")), mmap_mode='r')
+    return dict(zip(vocab['words'], matrix))
+
+
+def load_vectors(input_path, file_type):
+    if file_type == "pkl":
+        return load_pickle(input_path)
+    elif file_type == "w2v":
+        return load_w2v_emb(input_path)
+    elif file_type == "glove":
+        return load_glove_emb(input_path)
+    elif file_type == "wiki":
+        return load_fasttext_emb(input_path)
+
+
+def create_delta(base, vectors, removed_words):
+    delta = {'added': {}, 'replaced': {}, 'removed': []}
+    for word, vec in vectors.items():
+        section = 'replaced' if word in base else 'added'
+        delta[section][word] = np.asarray(vec, dtype=np.float32)
+    delta['removed'] = [w for w in removed_words if w in base]
+    return delta
+
+
+def apply_delta(base, delta):
+    for section in delta:
+        if section not in DELTA_SECTIONS:
+            raise ValueError("Unknown delta section {}".format(section))
+    for word in delta.get('removed', []):
+        base.pop(word, None)
+    for section in ('added', 'replaced'):
+        base.update(delta.get(section, {}))
+    return base
+
+
+def create(args):
+    base = load_pickle(Path(args.base_file))
+    vectors = load_vectors(Path(args.input_file), args.file_type)
+    removed_words = []
+    if args.removed_words:
+        removed_path = Path(args.removed_words)
+        with removed_path.open("r", encoding="utf8") as f:
+            removed_words = [line.rstrip("\n") for line in f if line.strip()]
+    delta = create_delta(base, vectors, removed_words)
+    print("Delta has {} added, {} replaced, {} removed".format(
+        len(delta['added']), len(delta['replaced']), len(delta['removed'])))
+    save_pickle(delta, Path(args.output_file))
+
+
+def compact(args):
+    base_path = Path(args.base_file)
+    output_path = Path(args.output_file)
+    if base_path.suffix in MATRIX_SUFFIXES:
+        if output_path.with_suffix(".npy") == base_path.with_suffix(".npy"):
+            raise ValueError("Can't compact a matrix into itself")
+        base = load_matrix(base_path)
+    else:
+        base = load_pickle(base_path)
+    for delta_file in args.delta_files:
+        apply_delta(base, load_pickle(Path(delta_file)))
+    print("Compacted vocabulary has {} words".format(len(base)))
+    if output_path.suffix in MATRIX_SUFFIXES:
+        # replaced words keep their rows, and added words go at the end
+        write_matrix(base, list(base), output_path.with_suffix(".npy"),
+                     output_path.with_suffix(".vocab"))
+    else:
+        save_pickle(base, output_path)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description='Create delta files, or compact them into a new PKL file')
+    SUBPARSERS = PARSER.add_subparsers(dest='command')
+    SUBPARSERS.required = True
+
+    CREATE_PARSER = SUBPARSERS.add_parser(
+        'create', help='Create a delta against a base PKL file')
+    CREATE_PARSER.add_argument('base_file', help='Base PKL file')
+    CREATE_PARSER.add_argument(
+        'input_file', help='New or replacement word vectors')
+    CREATE_PARSER.add_argument(
+        'file_type',
+        help='File type of input_file',
+        choices=['pkl', 'w2v', 'glove', 'wiki'])
+    CREATE_PARSER.add_argument('output_file', help='Output delta PKL file')
+    CREATE_PARSER.add_argument(
+        '--removed-words', help='Text file of words to remove, one per line')
+    CREATE_PARSER.set_defaults(func=create)
+
+    COMPACT_PARSER = SUBPARSERS.add_parser(
+        'compact', help='Fold delta files into a new base file')
+    COMPACT_PARSER.add_argument(
+        'base_file', help='Base PKL file, or .npy matrix from reorder_data.py')
+    COMPACT_PARSER.add_argument(
+        'output_file',
+        help='Output PKL file, or .npy to write a matrix and .vocab file')
+    COMPACT_PARSER.add_argument(
+        'delta_files', nargs='+', help='Delta PKL files, in applied order')
+    COMPACT_PARSER.set_defaults(func=compact)
+
+    BUILD_ARGS = PARSER.parse_args()
+    BUILD_ARGS.func(BUILD_ARGS)
@@ -0,0 +1,107 @@
+import argparse
+import collections
+import hashlib
+import os
+import pickle
+
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+
+SCRIPT_PATH = Path(os.path.dirname(os.path.realpath(__file__)))
+
+
+def load_hot_words(input_path, file_format):
+    """
+    Returns words ordered hottest first. A frequency file has one word per
+    line, optionally followed by whitespace and a count; without counts the
+    file order is used. An access log has one word per line for every access.
+    """
+    counts = collections.Counter()
+    with input_path.open("r", encoding="utf8") as f:
+        for rank, line in enumerate(f):
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if file_format == "access_log":
+                counts[line] += 1
+                continue
+            parts = line.rsplit(None, 1)
+            if len(parts) == 2 and parts[1].isdigit():
+                counts[parts[0]] = int(parts[1])
+            else:
+                counts[line.strip()] = -rank
+    return [word for word, _ in counts.most_common()]
+
+
+def reorder_words(embeddings, hot_words):
+    """Returns the words with hot words first, and the rest in their current
+    order"""
+    ordered = [word for word in dict.fromkeys(hot_words) if word in embeddings]
+    print("Moved {} hot words to the front".format(len(ordered)))
+    hot = set(ordered)
+    ordered.extend(word for word in embeddings if word not in hot)
+    return ordered
+
+
+def write_matrix(embeddings, words, matrix_path, vocab_path):
+    """
+    Writes the vectors as a contiguous float32 matrix in the order of words,
+    which the service memory-maps, and a vocabulary file holding the words,
+    the mean norm and a checksum of the matrix. The service derives the
+    model version from the vocabulary file, so it changes with the matrix.
+    """
+    dim = len(embeddings[words[0]])
+    print("Saving matrix to {}".format(matrix_path))
+    matrix = np.lib.format.open_memmap(
+        str(matrix_path), mode='w+', dtype=np.float32,
+        shape=(len(words), dim))
+    norm_total = 0.0
+    checksum = hashlib.sha256()
+    for row, word in enumerate(tqdm(words, desc='writing matrix')):
+        matrix[row] = embeddings[word]
+        norm_total += float(np.linalg.norm(matrix[row]))
+        checksum.update(matrix[row].tobytes())
+    matrix.flush()
+    del matrix
+
+    print("Saving vocabulary to {}".format(vocab_path))
+    with vocab_path.open('wb') as vocab_file:
+        pickle.dump({
+            'words': words,
+            'mean_norm': norm_total / len(words),
+            'checksum': checksum.hexdigest()
+        }, vocab_file)
+
+
+def main(args):
+    input_path = Path(args.input_file)
+    print("Loading file: {}".format(input_path))
+    with input_path.open('rb') as pkl_file:
+        embeddings = pickle.load(pkl_file)
+
+    hot_words = load_hot_words(Path(args.frequency_file), args.file_format)
+    words = reorder_words(embeddings, hot_words)
+
+    output_path = Path(args.output_file) if args.output_file else input_path
+    write_matrix(embeddings, words, output_path.with_suffix(".npy"),
+                 output_path.with_suffix(".vocab"))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description='Convert a PKL file to a matrix with frequently used words first')
+    PARSER.add_argument('input_file', help='Input PKL file')
+    PARSER.add_argument(
+        'frequency_file', help='Word frequency list or recorded access log')
+    PARSER.add_argument(
+        '--file-format',
+        help='Format of frequency_file',
+        choices=['frequency', 'access_log'],
+        default='frequency')
+    PARSER.add_argument(
+        '--output-file',
+        help='Output path, .npy and .vocab files are written next to it. '
+        'Defaults to input_file')
+    BUILD_ARGS = PARSER.parse_args()
+    main(BUILD_ARGS)
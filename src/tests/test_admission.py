@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from word2vec.admission import AdmissionController, AdmissionError
+
+
+def make_controller(max_queued=4, queue_timeout=1.0):
+    return AdmissionController(
+        max_inflight_words=100,
+        fast_lane_words=10,
+        max_queued=max_queued,
+        queue_timeout=queue_timeout,
+        retry_after=3)
+
+
+async def test_fast_lane_not_queued():
+    controller = make_controller()
+    async with controller.admit(100):
+        # the budget is used up, but small requests still go through
+        async with controller.admit(5):
+            pass
+    assert controller.counters['admitted_fast_lane'] == 1
+    assert controller.counters['admitted'] == 1
+    assert controller.inflight_words == 0
+
+
+async def test_queued_by_priority():
+    controller = make_controller()
+    order = []
+
+    async def request(name, priority):
+        async with controller.admit(60, priority):
+            order.append(name)
+
+    async with controller.admit(100):
+        tasks = [
+            asyncio.ensure_future(request("low", 0)),
+            asyncio.ensure_future(request("high", 5))
+        ]
+        await asyncio.sleep(0)
+        assert controller.queued == 2
+    await asyncio.gather(*tasks)
+    assert order == ["high", "low"]
+    assert controller.inflight_words == 0
+
+
+async def test_shed_when_queue_full():
+    controller = make_controller(max_queued=0)
+    async with controller.admit(100):
+        with pytest.raises(AdmissionError) as exc_info:
+            async with controller.admit(50):
+                pass
+    assert exc_info.value.retry_after == 3
+    assert controller.counters['shed_queue_full'] == 1
+
+
+async def test_shed_on_queue_timeout():
+    controller = make_controller(queue_timeout=0.01)
+    async with controller.admit(100):
+        with pytest.raises(AdmissionError):
+            async with controller.admit(50):
+                pass
+        assert controller.queued == 0
+    assert controller.counters['shed_queue_timeout'] == 1
+    assert controller.inflight_words == 0
+
+
+async def test_oversized_request_admitted_alone():
+    controller = make_controller()
+    async with controller.admit(500):
+        assert controller.inflight_words == 500
+    assert controller.inflight_words == 0
@@ -0,0 +1,68 @@
+import zlib
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from word2vec.compression import ResponseCompressor, parse_accept_encoding
+
+
+def make_compressor():
+    compressor = ResponseCompressor(
+        min_size=10, level=6, zstd_level=3, offload_size=1000)
+    compressor.available = ['gzip', 'deflate']
+    return compressor
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip;q=0.5, Deflate, br;q=x") == {
+        'gzip': 0.5,
+        'deflate': 1.0,
+        'br': 0.0
+    }
+
+
+def test_negotiate():
+    compressor = make_compressor()
+    assert compressor.negotiate("gzip, deflate") == "gzip"
+    assert compressor.negotiate("gzip;q=0.5, deflate") == "deflate"
+    assert compressor.negotiate("*") == "gzip"
+    assert compressor.negotiate("*, gzip;q=0") == "deflate"
+    assert compressor.negotiate("br") is None
+    assert compressor.negotiate("") is None
+
+
+def test_compress_round_trip():
+    compressor = make_compressor()
+    body = b'{"vectors": [0.1, 0.2, 0.3]}' * 100
+    compressed, cpu_secs = compressor.compress(body, 'gzip')
+    assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == body
+    compressed, cpu_secs = compressor.compress(body, 'deflate')
+    assert zlib.decompress(compressed) == body
+    assert cpu_secs >= 0
+
+
+async def test_compress_response_offloaded():
+    compressor = make_compressor()
+    body = b'{"vectors": [0.1, 0.2, 0.3]}' * 100
+    request = make_mocked_request(
+        'POST', '/words', headers={'Accept-Encoding': 'deflate'})
+    response = await compressor.compress_response(request,
+                                                  web.Response(body=body))
+    assert response.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(response.body) == body
+    assert compressor.counters['deflate_bytes_in'] == len(body)
+
+
+async def test_vary_on_uncompressed_response():
+    compressor = make_compressor()
+    request = make_mocked_request(
+        'POST', '/words', headers={'Accept-Encoding': 'identity'})
+    response = await compressor.compress_response(
+        request, web.Response(body=b'x' * 100))
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+    # bodies below the threshold are never compressed, so don't vary
+    response = await compressor.compress_response(request,
+                                                  web.Response(body=b'x'))
+    assert 'Vary' not in response.headers
@@ -0,0 +1,44 @@
+from word2vec.lookup import SecondaryIndex
+
+FALLBACKS = ['lower', 'nfkc', 'unaccent']
+
+
+def make_index(words):
+    index = SecondaryIndex(FALLBACKS)
+    index.build(words)
+    return index
+
+
+def test_index_stores_each_key_once():
+    # Word only needs lowercasing, Émile is lowercased then unaccented and
+    # word2 is already normalised
+    index = make_index(["Word", "Émile", "word2"])
+    assert len(index) == 3
+
+
+def test_resolve_key_reached_at_later_step():
+    words = {"Caf\u00e9": 1}
+    index = make_index(words)
+    # lowercasing leaves the accent decomposed, it's only composed by nfkc
+    decomposed = "CAFE\u0301"
+    assert index.resolve([decomposed], words, ['lower']) == {}
+    resolved = index.resolve([decomposed], words, ['lower', 'nfkc'])
+    assert resolved == {decomposed: ("Caf\u00e9", 'nfkc')}
+
+
+def test_resolve_checks_key_at_step():
+    words = {"ﬁle": 1}
+    index = make_index(words)
+    # ﬁle only becomes file with nfkc, so lowercasing alone doesn't match
+    assert index.resolve(["FILE"], words, ['lower']) == {}
+    assert index.resolve(["FILE"], words) == {"FILE": ("ﬁle", 'nfkc')}
+
+
+def test_with_words_leaves_original():
+    words = {"Word": 1}
+    index = make_index(words)
+    added = index.with_words(["Émile"])
+    words["Émile"] = 2
+    assert index.resolve(["emile"], words) == {}
+    assert added.resolve(["emile"], words) == {"emile": ("Émile", 'unaccent')}
+    assert len(added) == len(index) + 2
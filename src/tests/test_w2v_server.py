@@ -1,11 +1,20 @@
 import os
+import asyncio
+import threading
+import types
+import gzip
+import json
 import numbers
+import pickle
 from pathlib import Path
 
+import numpy
 import pytest
 from aiohttp import web
 
 import word2vec.server
+import word2vec.svc_config
+import word2vec.w2v
 
 TEST_PATH = Path(os.path.dirname(os.path.realpath(__file__)))
 
@@ -111,3 +120,583 @@ async def test_multiple_test_words(cli):
     for test_word in TEST_WORDS[:2]:
         vector = vectors[test_word]
         check_vector_numeric(vector)
+
+
+@pytest.fixture()
+def delta_cli(loop, aiohttp_client):
+    """Applying deltas changes the vectors, so use a freshly loaded server
+    rather than the shared module level one"""
+    server = word2vec.server.Word2VecServer()
+    server.load(str(TEST_PATH / "data_test_embedding"))
+    web_app = web.Application()
+    word2vec.server.initialize_web_app(web_app, server)
+    return loop.run_until_complete(aiohttp_client(web_app)), server
+
+
+def write_delta(path, delta):
+    with path.open('wb') as pkl_file:
+        pickle.dump(delta, pkl_file)
+    return str(path)
+
+
+async def test_apply_delta(delta_cli, tmp_path):
+    cli, server = delta_cli
+    start_version = server.version
+    delta_path = write_delta(
+        tmp_path / "test.delta.pkl", {
+            'added': {
+                'frobble': numpy.ones(300, dtype=numpy.float32)
+            },
+            'replaced': {
+                'MetroCard': numpy.full(300, 2.0, dtype=numpy.float32)
+            },
+            'removed': ['RockBand']
+        })
+
+    resp = await cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["version"] != start_version
+    assert json_data["version"] == server.version
+
+    resp = await cli.post(
+        '/words', json={"words": ["frobble", "MetroCard", "RockBand"]})
+    vectors = (await resp.json())["vectors"]
+    assert vectors["frobble"] == [1.0] * 300
+    assert vectors["MetroCard"] == [2.0] * 300
+    assert "RockBand" not in vectors
+
+    # words added by the delta can be found with fallbacks too
+    resp = await cli.post('/lookup', json={"words": ["FROBBLE"]})
+    json_data = await resp.json()
+    assert json_data["matches"]["FROBBLE"]["word"] == "frobble"
+
+    # added words are numbered after the base vocabulary
+    resp = await cli.post('/ids', json={"words": ["frobble", "RockBand"]})
+    json_data = await resp.json()
+    assert json_data["ids"] == {"frobble": 101}
+    assert json_data["unk_words"] == ["RockBand"]
+
+
+async def test_apply_delta_updates_mean_norm(delta_cli, tmp_path):
+    cli, server = delta_cli
+    delta_path = write_delta(tmp_path / "test.delta.pkl", {
+        'added': {
+            'frobble': numpy.ones(300, dtype=numpy.float32)
+        },
+        'removed': ['MetroCard']
+    })
+    resp = await cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 200
+
+    # the incremental mean norm should match a full recalculation
+    with (TEST_PATH / "data_test_embedding.pkl").open('rb') as pkl_file:
+        expected_vectors = pickle.load(pkl_file)
+    del expected_vectors['MetroCard']
+    expected_vectors['frobble'] = numpy.ones(300, dtype=numpy.float32)
+    expected = numpy.mean(
+        numpy.linalg.norm(
+            numpy.array(list(expected_vectors.values())), axis=1))
+    assert numpy.isclose(server.mean_norm, expected)
+
+
+async def test_apply_delta_bad_dimension(delta_cli, tmp_path):
+    cli, server = delta_cli
+    start_version = server.version
+    delta_path = write_delta(tmp_path / "test.delta.pkl", {
+        'added': {
+            'frobble': numpy.ones(10, dtype=numpy.float32)
+        },
+    })
+    resp = await cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 400
+    assert server.version == start_version
+
+
+async def test_apply_delta_missing_file(delta_cli, tmp_path):
+    cli, _ = delta_cli
+    resp = await cli.post(
+        '/apply_delta', json={"path": str(tmp_path / "missing.pkl")})
+    assert resp.status == 400
+
+
+@pytest.fixture()
+def limited_cli(loop, aiohttp_client, monkeypatch):
+    monkeypatch.setenv('W2V_MAX_WORDS_PER_REQUEST', '3')
+    monkeypatch.setenv('W2V_MAX_BODY_SIZE', '200')
+    config = word2vec.svc_config.SvcConfig()
+    server = word2vec.server.Word2VecServer(config)
+    server.load(str(TEST_PATH / "data_test_embedding"))
+    web_app = web.Application(client_max_size=config.max_body_size)
+    word2vec.server.initialize_web_app(web_app, server)
+    return loop.run_until_complete(aiohttp_client(web_app))
+
+
+@pytest.fixture()
+def vectors_gate():
+    """Events to hold large requests while they gather the vectors: started
+    is set once one is running, and it carries on once release is set"""
+    return types.SimpleNamespace(
+        started=threading.Event(), release=threading.Event())
+
+
+@pytest.fixture()
+def shedding_cli(loop, aiohttp_client, monkeypatch, mocker, vectors_gate):
+    """A server with room for a single large request at a time and no queue,
+    where large requests wait on vectors_gate so that they overlap"""
+    monkeypatch.setenv('W2V_MAX_INFLIGHT_WORDS', '150')
+    monkeypatch.setenv('W2V_MAX_QUEUED_REQUESTS', '0')
+    monkeypatch.setenv('W2V_FAST_LANE_WORDS', '10')
+    monkeypatch.setenv('W2V_RETRY_AFTER', '2')
+    server = word2vec.server.Word2VecServer(word2vec.svc_config.SvcConfig())
+    server.load(str(TEST_PATH / "data_test_embedding"))
+    get_vectors_json = server.get_vectors_json
+
+    def gated_get_vectors_json(state, words):
+        if len(words) > 10:
+            vectors_gate.started.set()
+            vectors_gate.release.wait(timeout=5)
+        return get_vectors_json(state, words)
+
+    mocker.patch.object(
+        server, "get_vectors_json", side_effect=gated_get_vectors_json)
+    web_app = web.Application()
+    word2vec.server.initialize_web_app(web_app, server)
+    return loop.run_until_complete(aiohttp_client(web_app))
+
+
+async def start_large_request(cli, gate):
+    """Posts a large request, returning once it holds its admission"""
+    large = asyncio.ensure_future(
+        cli.post('/words', json={"words": ["MetroCard"] * 100}))
+    started = await asyncio.get_event_loop().run_in_executor(
+        None, gate.started.wait, 5)
+    assert started
+    return large
+
+
+async def test_concurrent_requests_shed(shedding_cli, vectors_gate):
+    large = await start_large_request(shedding_cli, vectors_gate)
+    words = ["MetroCard"] * 100
+    responses = await asyncio.gather(*[
+        shedding_cli.post('/words', json={"words": words}) for _ in range(4)
+    ])
+    for resp in responses:
+        assert resp.status == 429
+        assert resp.headers['Retry-After'] == '2'
+    vectors_gate.release.set()
+    assert (await large).status == 200
+
+    resp = await shedding_cli.get('/admission_stats')
+    json_data = await resp.json()
+    assert json_data["admitted"] == 1
+    assert json_data["shed_queue_full"] == 4
+    assert json_data["inflight_words"] == 0
+
+
+async def test_fast_lane_not_blocked(shedding_cli, vectors_gate):
+    large = await start_large_request(shedding_cli, vectors_gate)
+    resp = await shedding_cli.post('/words', json={"words": ["MetroCard"]})
+    assert resp.status == 200
+    # the small request doesn't wait for the large one to finish
+    assert not large.done()
+    vectors_gate.release.set()
+    assert (await large).status == 200
+
+
+async def test_apply_delta_during_request(shedding_cli, vectors_gate,
+                                          tmp_path):
+    resp = await shedding_cli.post('/words', json={"words": ["MetroCard"]})
+    before = (await resp.json())["vectors"]["MetroCard"]
+    large = await start_large_request(shedding_cli, vectors_gate)
+    delta_path = write_delta(
+        tmp_path / "test.delta.pkl", {
+            'replaced': {
+                'MetroCard': numpy.full(300, 2.0, dtype=numpy.float32)
+            }
+        })
+    resp = await shedding_cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 200
+    vectors_gate.release.set()
+
+    # the running request carries on with the model it started with
+    json_data = await (await large).json()
+    assert json_data["vectors"]["MetroCard"] == before
+    resp = await shedding_cli.post('/words', json={"words": ["MetroCard"]})
+    assert (await resp.json())["vectors"]["MetroCard"] == [2.0] * 300
+
+
+async def test_too_many_words(limited_cli):
+    resp = await limited_cli.post(
+        '/words', json={"words": ["a", "b", "c", "d"]})
+    assert resp.status == 413
+
+    resp = await limited_cli.get('/admission_stats')
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["shed_too_many_words"] == 1
+
+
+async def test_body_too_large(limited_cli):
+    resp = await limited_cli.post(
+        '/unk_words', json={"words": ["a" * 300]})
+    assert resp.status == 413
+
+    resp = await limited_cli.get('/admission_stats')
+    json_data = await resp.json()
+    assert json_data["shed_body_too_large"] == 1
+
+
+def write_matrix(path, embeddings, words):
+    numpy.save(
+        str(path.with_suffix(".npy")),
+        numpy.array([embeddings[w] for w in words], dtype=numpy.float32))
+    mean_norm = numpy.mean(
+        numpy.linalg.norm(numpy.array(list(embeddings.values())), axis=1))
+    with path.with_suffix(".vocab").open('wb') as vocab_file:
+        pickle.dump({'words': words, 'mean_norm': mean_norm}, vocab_file)
+
+
+@pytest.fixture()
+def matrix_path(tmp_path):
+    """A memory-mappable copy of the test embeddings, in reverse row order"""
+    with (TEST_PATH / "data_test_embedding.pkl").open('rb') as pkl_file:
+        embeddings = pickle.load(pkl_file)
+    path = tmp_path / "data_test_embedding"
+    write_matrix(path, embeddings, list(reversed(list(embeddings))))
+    return path
+
+
+async def test_load_matrix(loop, aiohttp_client, matrix_path):
+    server = word2vec.server.Word2VecServer(word2vec.svc_config.SvcConfig())
+    server.load(str(matrix_path))
+    web_app = web.Application()
+    word2vec.server.initialize_web_app(web_app, server)
+    matrix_cli = await aiohttp_client(web_app)
+
+    with (TEST_PATH / "data_test_embedding.pkl").open('rb') as pkl_file:
+        embeddings = pickle.load(pkl_file)
+    resp = await matrix_cli.post('/words', json={"words": ["MetroCard"]})
+    vectors = (await resp.json())["vectors"]
+    assert numpy.allclose(vectors["MetroCard"], embeddings["MetroCard"])
+
+    # row ids follow the order of the matrix
+    last_word = list(embeddings)[-1]
+    resp = await matrix_cli.post('/ids', json={"words": [last_word]})
+    assert (await resp.json())["ids"] == {last_word: 0}
+
+
+def test_load_matrix_older_than_pickle(matrix_path, caplog):
+    pkl_path = matrix_path.with_suffix(".pkl")
+    pkl_path.write_bytes(
+        (TEST_PATH / "data_test_embedding.pkl").read_bytes())
+    matrix_mtime = matrix_path.with_suffix(".npy").stat().st_mtime
+    os.utime(str(pkl_path), (matrix_mtime + 10, matrix_mtime + 10))
+
+    embeddings = word2vec.w2v.Word2Vec(path=str(matrix_path)).load_embeddings()
+    # the matrix is still used, but flagged as possibly out of date
+    assert isinstance(embeddings.rows, numpy.memmap)
+    assert "may be out of date" in caplog.text
+
+
+def test_prewarm_matrix(matrix_path):
+    wv = word2vec.w2v.Word2Vec(path=str(matrix_path))
+    embeddings = wv.load_embeddings()
+    assert isinstance(embeddings.rows, numpy.memmap)
+    assert wv.prewarm(embeddings, 10) == 10
+    assert wv.prewarm(embeddings, 1000) == len(embeddings)
+
+
+def test_prewarm_skips_pickle():
+    wv = word2vec.w2v.Word2Vec(path=str(TEST_PATH / "data_test_embedding"))
+    embeddings = wv.load_embeddings()
+    # unpickled vectors are already in memory
+    assert wv.prewarm(embeddings, 10) == 0
+
+
+async def test_lookup_fallbacks(cli):
+    TEST_WORDS = ["MetroCard", "METROCARD", "ｊｅｄｅ", "ajoutér", "frobble"]
+    resp = await cli.post('/lookup', json={"words": TEST_WORDS})
+    assert resp.status == 200
+
+    json_data = await resp.json()
+    vectors = json_data["vectors"]
+    for test_word in TEST_WORDS[:4]:
+        check_vector_numeric(vectors[test_word])
+    assert vectors["METROCARD"] == vectors["MetroCard"]
+    assert json_data["unk_words"] == ["frobble"]
+    assert json_data["matches"] == {
+        "METROCARD": {
+            "word": "MetroCard",
+            "fallback": "lower"
+        },
+        "ｊｅｄｅ": {
+            "word": "jede",
+            "fallback": "nfkc"
+        },
+        "ajoutér": {
+            "word": "ajouter",
+            "fallback": "unaccent"
+        }
+    }
+
+
+async def test_lookup_fallback_order(cli):
+    resp = await cli.post(
+        '/lookup', json={
+            "words": ["METROCARD", "ajoutér"],
+            "fallbacks": ["lower"]
+        })
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["matches"]["METROCARD"]["word"] == "MetroCard"
+    assert json_data["unk_words"] == ["ajoutér"]
+
+    # fallbacks are cumulative, so only a prefix of the configured order can
+    # be used
+    for fallbacks in (["unaccent"], ["soundex"]):
+        resp = await cli.post(
+            '/lookup', json={
+                "words": ["METROCARD"],
+                "fallbacks": fallbacks
+            })
+        assert resp.status == 400
+
+
+async def test_lookup_composed_fallbacks(cli):
+    TEST_WORDS = ["Ajoutér", "AJOUTÉR", "ＭＥＴＲＯＣＡＲＤ"]
+    resp = await cli.post('/lookup', json={"words": TEST_WORDS})
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["unk_words"] == []
+    assert json_data["matches"] == {
+        "Ajoutér": {
+            "word": "ajouter",
+            "fallback": "unaccent"
+        },
+        "AJOUTÉR": {
+            "word": "ajouter",
+            "fallback": "unaccent"
+        },
+        "ＭＥＴＲＯＣＡＲＤ": {
+            "word": "MetroCard",
+            "fallback": "nfkc"
+        }
+    }
+
+
+async def test_lookup_after_delta_removes_word(delta_cli, tmp_path):
+    cli, _ = delta_cli
+    delta_path = write_delta(tmp_path / "add.delta.pkl", {
+        'added': {
+            'METROCARD': numpy.ones(300, dtype=numpy.float32)
+        },
+    })
+    resp = await cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 200
+    delta_path = write_delta(tmp_path / "remove.delta.pkl", {
+        'removed': ['MetroCard'],
+    })
+    resp = await cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 200
+
+    # both words lowercase to metrocard, the remaining one is found
+    resp = await cli.post('/lookup', json={"words": ["Metrocard"]})
+    json_data = await resp.json()
+    assert json_data["matches"]["Metrocard"]["word"] == "METROCARD"
+
+
+def test_version_from_content(tmp_path, w2v_server, matrix_path):
+    # a fresh server loading the same file reports the same version
+    server = word2vec.server.Word2VecServer()
+    server.load(str(TEST_PATH / "data_test_embedding"))
+    assert server.version == w2v_server.version
+
+    # the same vectors in a different row order are a different version
+    matrix_server = word2vec.server.Word2VecServer()
+    matrix_server.load(str(matrix_path))
+    assert matrix_server.version != server.version
+
+    # replicas applying the same deltas agree, whatever happened before
+    delta_path = write_delta(tmp_path / "test.delta.pkl", {
+        'added': {
+            'frobble': numpy.ones(300, dtype=numpy.float32)
+        },
+    })
+    other = word2vec.server.Word2VecServer()
+    other.load(str(TEST_PATH / "data_test_embedding"))
+    other.load(str(TEST_PATH / "data_test_embedding"))
+    server.apply_delta(delta_path)
+    other.apply_delta(delta_path)
+    assert server.version == other.version
+    assert server.version != w2v_server.version
+
+
+async def test_ids_and_vectors_by_id(cli, w2v_server):
+    TEST_WORDS = ["MetroCard", "RockBand", "frobble"]
+    resp = await cli.post('/ids', json={"words": TEST_WORDS})
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["version"] == w2v_server.version
+    assert json_data["unk_words"] == ["frobble"]
+    ids = [json_data["ids"][w] for w in TEST_WORDS[:2]]
+
+    resp = await cli.post('/vectors_by_id', json={"ids": ids + [100000]})
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["words"] == TEST_WORDS[:2] + [None]
+    assert json_data["vectors"][2] is None
+
+    resp = await cli.post('/words', json={"words": TEST_WORDS[:2]})
+    vectors = (await resp.json())["vectors"]
+    for i, word in enumerate(TEST_WORDS[:2]):
+        assert json_data["vectors"][i] == vectors[word]
+
+
+async def test_vectors_by_id_range_binary(cli, w2v_server):
+    resp = await cli.post(
+        '/vectors_by_id',
+        json={
+            "start": 0,
+            "end": 3
+        },
+        headers={'Accept': 'application/octet-stream'})
+    assert resp.status == 200
+    assert resp.headers["X-Model-Version"] == w2v_server.version
+    assert resp.headers["X-Row-Count"] == "3"
+    rows = numpy.frombuffer(await resp.read(), dtype='<f4').reshape(3, -1)
+
+    resp = await cli.post('/vectors_by_id', json={"start": 0, "end": 3})
+    json_data = await resp.json()
+    assert numpy.allclose(rows, numpy.array(json_data["vectors"]))
+
+
+async def test_vectors_by_id_during_delta(loop, aiohttp_client, monkeypatch,
+                                          mocker, vectors_gate, tmp_path):
+    monkeypatch.setenv('W2V_FAST_LANE_WORDS', '0')
+    server = word2vec.server.Word2VecServer(word2vec.svc_config.SvcConfig())
+    server.load(str(TEST_PATH / "data_test_embedding"))
+    get_vectors_by_id = server.get_vectors_by_id
+
+    def gated_get_vectors_by_id(state, ids, binary):
+        vectors_gate.started.set()
+        vectors_gate.release.wait(timeout=5)
+        return get_vectors_by_id(state, ids, binary)
+
+    mocker.patch.object(
+        server, "get_vectors_by_id", side_effect=gated_get_vectors_by_id)
+    web_app = web.Application()
+    word2vec.server.initialize_web_app(web_app, server)
+    cli = await aiohttp_client(web_app)
+
+    resp = await cli.post('/ids', json={"words": ["MetroCard"]})
+    json_data = await resp.json()
+    start_version = json_data["version"]
+    word_id = json_data["ids"]["MetroCard"]
+    resp = await cli.post('/words', json={"words": ["MetroCard"]})
+    before = (await resp.json())["vectors"]["MetroCard"]
+
+    request = asyncio.ensure_future(
+        cli.post(
+            '/vectors_by_id',
+            json={"ids": [word_id]},
+            headers={'Accept': 'application/octet-stream'}))
+    started = await asyncio.get_event_loop().run_in_executor(
+        None, vectors_gate.started.wait, 5)
+    assert started
+    delta_path = write_delta(
+        tmp_path / "test.delta.pkl", {
+            'replaced': {
+                'MetroCard': numpy.full(300, 2.0, dtype=numpy.float32)
+            }
+        })
+    resp = await cli.post('/apply_delta', json={"path": delta_path})
+    assert resp.status == 200
+    vectors_gate.release.set()
+
+    # the version matches the rows that were sent, not the applied delta
+    resp = await request
+    assert resp.headers["X-Model-Version"] == start_version
+    assert server.version != start_version
+    rows = numpy.frombuffer(await resp.read(), dtype='<f4')
+    assert numpy.allclose(rows, before)
+
+
+async def test_vectors_by_id_bad_request(cli):
+    resp = await cli.post('/vectors_by_id', json={"ids": ["MetroCard"]})
+    assert resp.status == 400
+    resp = await cli.post('/vectors_by_id', json={"start": 5, "end": 2})
+    assert resp.status == 400
+
+
+async def test_compressed_response(cli, w2v_server):
+    TEST_WORDS = ["MetroCard", "RockBand"]
+    resp = await cli.post(
+        '/words',
+        json={"words": TEST_WORDS},
+        headers={'Accept-Encoding': 'gzip'})
+    assert resp.status == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    compressed_vectors = (await resp.json())["vectors"]
+
+    resp = await cli.post(
+        '/words',
+        json={"words": TEST_WORDS},
+        headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert (await resp.json())["vectors"] == compressed_vectors
+
+    resp = await cli.get('/compression_stats')
+    json_data = await resp.json()
+    assert json_data["gzip_bytes_out"] < json_data["gzip_bytes_in"]
+
+
+async def test_compressed_request(cli):
+    body = gzip.compress(json.dumps({"words": ["MetroCard"]}).encode())
+    resp = await cli.post(
+        '/unk_words',
+        data=body,
+        headers={
+            'Content-Encoding': 'gzip',
+            'Content-Type': 'application/json'
+        })
+    assert resp.status == 200
+    json_data = await resp.json()
+    assert json_data["unk_words"] == []
+
+
+async def test_apply_delta_corrupt_file(delta_cli, tmp_path):
+    cli, _ = delta_cli
+    delta_path = tmp_path / "corrupt.delta.pkl"
+    delta_path.write_bytes(b"not a pickle")
+    resp = await cli.post('/apply_delta', json={"path": str(delta_path)})
+    assert resp.status == 400
+
+
+async def test_apply_delta_bad_section_type(delta_cli, tmp_path):
+    cli, server = delta_cli
+    start_version = server.version
+    for delta in ({'added': ['frobble']}, {'removed': 'MetroCard'}):
+        delta_path = write_delta(tmp_path / "bad.delta.pkl", delta)
+        resp = await cli.post('/apply_delta', json={"path": delta_path})
+        assert resp.status == 400
+    assert server.version == start_version
+
+
+async def test_decompressed_body_too_large(limited_cli):
+    body = gzip.compress(json.dumps({"words": ["a" * 300]}).encode())
+    assert len(body) < 200
+    resp = await limited_cli.post(
+        '/words',
+        data=body,
+        headers={
+            'Content-Encoding': 'gzip',
+            'Content-Type': 'application/json'
+        })
+    assert resp.status == 413
+
+    resp = await limited_cli.get('/admission_stats')
+    json_data = await resp.json()
+    assert json_data["shed_body_too_large"] == 1
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+
+
+def _get_logger():
+    logger = logging.getLogger('word2vec.admission')
+    return logger
+
+
+class AdmissionError(Exception):
+    """Raised when a request is shed rather than admitted"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    """
+    Limits the number of words being processed at once across requests.
+    Small requests go through a fast lane and are never queued behind large
+    ones. Large requests that don't fit are queued by priority (higher
+    first), and shed once the queue is full or they have waited too long.
+    """
+
+    def __init__(self, max_inflight_words, fast_lane_words, max_queued,
+                 queue_timeout, retry_after):
+        self.max_inflight_words = max_inflight_words
+        self.fast_lane_words = fast_lane_words
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.__inflight_words = 0
+        self.__queue = []
+        self.__sequence = itertools.count()
+        self.counters = collections.Counter()
+        self.logger = _get_logger()
+
+    @property
+    def inflight_words(self):
+        return self.__inflight_words
+
+    @property
+    def queued(self):
+        return len(self.__queue)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['inflight_words'] = self.__inflight_words
+        stats['queued'] = len(self.__queue)
+        return stats
+
+    def shed(self, reason):
+        self.counters['shed_{}'.format(reason)] += 1
+        self.logger.warning("Shedding request: {}".format(reason))
+        raise AdmissionError(reason, self.retry_after)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, num_words, priority=0):
+        if num_words <= self.fast_lane_words:
+            self.counters['admitted_fast_lane'] += 1
+            yield
+            return
+
+        await self.__acquire(num_words, priority)
+        self.counters['admitted'] += 1
+        try:
+            yield
+        finally:
+            self.__inflight_words -= num_words
+            self.__wake_waiters()
+
+    def __fits(self, num_words):
+        # a single request larger than the budget is let through on its own,
+        # otherwise it could never be admitted
+        return (self.__inflight_words == 0 or self.__inflight_words +
+                num_words <= self.max_inflight_words)
+
+    async def __acquire(self, num_words, priority):
+        if not self.__queue and self.__fits(num_words):
+            self.__inflight_words += num_words
+            return
+        if len(self.__queue) >= self.max_queued:
+            self.shed('queue_full')
+
+        future = asyncio.get_event_loop().create_future()
+        entry = (-priority, next(self.__sequence), num_words, future)
+        heapq.heappush(self.__queue, entry)
+        self.counters['queued'] += 1
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.__abandon(entry)
+            self.shed('queue_timeout')
+        except asyncio.CancelledError:
+            self.__abandon(entry)
+            raise
+
+    def __abandon(self, entry):
+        _, _, num_words, future = entry
+        if future.done():
+            # admitted just as we gave up, give the words back
+            self.__inflight_words -= num_words
+            self.__wake_waiters()
+        else:
+            future.cancel()
+            self.__queue.remove(entry)
+            heapq.heapify(self.__queue)
+            # the head of the queue may have been blocked behind this entry
+            self.__wake_waiters()
+
+    def __wake_waiters(self):
+        while self.__queue:
+            _, _, num_words, future = self.__queue[0]
+            if not self.__fits(num_words):
+                break
+            heapq.heappop(self.__queue)
+            self.__inflight_words += num_words
+            future.set_result(None)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import time
+import zlib
+
+from aiohttp import web
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# preferred first when the client accepts several encodings equally
+PREFERRED_ENCODINGS = ('zstd', 'gzip', 'deflate')
+
+
+def parse_accept_encoding(header):
+    """Returns a dictionary of encoding to q-value from an Accept-Encoding
+    header"""
+    accepted = {}
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].lower()] = quality
+    return accepted
+
+
+class ResponseCompressor(object):
+    """
+    Compresses responses with gzip, deflate or zstd (when the zstandard
+    library is installed), as negotiated with the Accept-Encoding header.
+    Bodies smaller than min_size are sent as is, and bodies of offload_size
+    or more are compressed in a thread so the event loop isn't blocked.
+    Compressed request bodies are decoded by aiohttp itself.
+    """
+
+    def __init__(self, min_size, level, zstd_level, offload_size):
+        self.min_size = min_size
+        self.level = level
+        self.zstd_level = zstd_level
+        self.offload_size = offload_size
+        self.counters = collections.Counter()
+        self.available = [
+            e for e in PREFERRED_ENCODINGS if e != 'zstd' or zstandard
+        ]
+
+    def stats(self):
+        return dict(self.counters)
+
+    def negotiate(self, accept_encoding):
+        """Returns the encoding to use, or None to send the body as is"""
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_quality = None, 0.0
+        for encoding in self.available:
+            quality = accepted.get(encoding, accepted.get('*', 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, body, encoding):
+        """Returns the compressed body, and the CPU time taken"""
+        start = time.thread_time()
+        if encoding == 'zstd':
+            compressed = zstandard.ZstdCompressor(
+                level=self.zstd_level).compress(body)
+        elif encoding == 'gzip':
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(body) + compressor.flush()
+        else:
+            compressed = zlib.compress(body, self.level)
+        return compressed, time.thread_time() - start
+
+    async def compress_response(self, request, response):
+        body = response.body
+        if not isinstance(body, bytes) or len(body) < self.min_size or \
+                'Content-Encoding' in response.headers:
+            return response
+        # the body depends on Accept-Encoding whether or not it's compressed,
+        # so shared caches must key on it
+        response.headers['Vary'] = 'Accept-Encoding'
+        encoding = self.negotiate(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            self.counters['uncompressed_bytes'] += len(body)
+            return response
+
+        if len(body) >= self.offload_size:
+            loop = asyncio.get_event_loop()
+            compressed, cpu_secs = await loop.run_in_executor(
+                None, self.compress, body, encoding)
+        else:
+            compressed, cpu_secs = self.compress(body, encoding)
+        self.counters['{}_cpu_secs'.format(encoding)] += cpu_secs
+        self.counters['{}_bytes_in'.format(encoding)] += len(body)
+        self.counters['{}_bytes_out'.format(encoding)] += len(compressed)
+        response.body = compressed
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def middleware(self):
+        @web.middleware
+        async def compression_middleware(request, handler):
+            response = await handler(request)
+            if isinstance(response, web.Response):
+                response = await self.compress_response(request, response)
+            return response
+
+        return compression_middleware
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import unicodedata
+
+from word2vec.w2v import Word2VecError
+
+
+def _get_logger():
+    logger = logging.getLogger('word2vec.lookup')
+    return logger
+
+
+def _strip_accents(word):
+    decomposed = unicodedata.normalize('NFKD', word)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return unicodedata.normalize('NFC', stripped)
+
+
+NORMALISERS = {
+    'lower': str.lower,
+    'nfkc': lambda word: unicodedata.normalize('NFKC', word),
+    'unaccent': _strip_accents,
+}
+
+
+def check_fallbacks(fallbacks, allowed=NORMALISERS):
+    unknown = [f for f in fallbacks if f not in allowed]
+    if unknown:
+        raise Word2VecError(
+            "Unknown fallbacks {}, expected some of {}".format(
+                unknown, sorted(allowed)))
+
+
+def check_fallback_prefix(fallbacks, configured):
+    if list(fallbacks) != configured[:len(fallbacks)]:
+        raise Word2VecError(
+            "Fallbacks {} must be a prefix of the configured order {}".format(
+                fallbacks, configured))
+
+
+class SecondaryIndex(object):
+    """
+    Maps normalised forms of the vocabulary back to canonical words.
+    Fallbacks are applied cumulatively in the configured order, so with
+    lower, nfkc, unaccent the last key is the lowercased, NFKC and
+    accent-stripped form. A word is stored once under each distinct key it
+    passes through, so a word that only needs lowercasing takes a single
+    entry, and words found as given take none. When several words share a
+    key they are all kept in row order, and the first one still in the
+    vocabulary is used.
+
+    The index built for the base vocabulary is never changed afterwards.
+    Words added by deltas go into a small separate layer, in a copy made by
+    with_words, so an index can be read while the next one is prepared.
+    """
+
+    def __init__(self, fallbacks):
+        check_fallbacks(fallbacks)
+        self.fallbacks = list(fallbacks)
+        self.__index = {}
+        self.__added = {}
+        self.logger = _get_logger()
+
+    def __len__(self):
+        return len(self.__index) + len(self.__added)
+
+    def build(self, words):
+        tStart = time.time()
+        for word in words:
+            self.__add(self.__index, word)
+        self.logger.info("Built lookup index of {} keys: {} secs".format(
+            len(self.__index),
+            time.time() - tStart))
+
+    def normalised_keys(self, word, fallbacks):
+        """Yields (fallback name, key) applying the fallbacks cumulatively"""
+        key = word
+        for name in fallbacks:
+            key = NORMALISERS[name](key)
+            yield name, key
+
+    def with_words(self, words):
+        """Returns a copy of this index with words added"""
+        other = SecondaryIndex.__new__(SecondaryIndex)
+        other.fallbacks = self.fallbacks
+        other.logger = self.logger
+        other.__index = self.__index
+        other.__added = {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in self.__added.items()
+        }
+        for word in words:
+            other.__add(other.__added, word)
+        return other
+
+    def __add(self, index, word):
+        previous = word
+        for _, key in self.normalised_keys(word, self.fallbacks):
+            if key == previous:
+                continue
+            previous = key
+            # most keys have a single word, so only use a list on collisions
+            existing = index.get(key)
+            if existing is None:
+                index[key] = word
+            elif isinstance(existing, list):
+                if word not in existing:
+                    existing.append(word)
+            elif existing != word:
+                index[key] = [existing, word]
+
+    def __candidates(self, key):
+        candidates = []
+        for index in (self.__index, self.__added):
+            found = index.get(key)
+            if isinstance(found, list):
+                candidates.extend(found)
+            elif found is not None:
+                candidates.append(found)
+        return candidates
+
+    def __key_at(self, word, step):
+        key = word
+        for name in self.fallbacks[:step + 1]:
+            key = NORMALISERS[name](key)
+        return key
+
+    def resolve(self, words, w2v, fallbacks=None):
+        """
+        Resolves a batch of words against w2v, returning a dictionary of
+        word to (canonical word, fallback name) for every word that was
+        found. An exact match has fallback 'exact', otherwise the fallback
+        is the last one that was applied. fallbacks must be a prefix of the
+        configured order, to stop after fewer fallbacks.
+        """
+        if fallbacks is None:
+            fallbacks = self.fallbacks
+        check_fallback_prefix(fallbacks, self.fallbacks)
+        resolved = {}
+        for word in set(words):
+            match = self.__resolve_word(word, w2v, fallbacks)
+            if match is not None:
+                resolved[word] = match
+        return resolved
+
+    def __resolve_word(self, word, w2v, fallbacks):
+        if word in w2v:
+            return word, 'exact'
+        previous, candidates = None, []
+        for step, (name, key) in enumerate(
+                self.normalised_keys(word, fallbacks)):
+            if key != previous:
+                if key in w2v:
+                    return key, name
+                candidates = self.__candidates(key)
+                previous = key
+            # a key is shared by all the steps that left it unchanged, so
+            # check the candidate has this key at this step. Words may also
+            # since have been removed by a delta
+            for canonical in candidates:
+                if canonical in w2v and \
+                        self.__key_at(canonical, step) == key:
+                    return canonical, name
+        return None
@@ -2,6 +2,8 @@
 
 import os
 import json
+import asyncio
+import collections
 import yaml
 import logging
 import logging.config
@@ -13,8 +15,12 @@ import aiohttp
 from aiohttp import web
 import numpy
 
-from word2vec.w2v import Word2Vec
+from word2vec.w2v import Word2Vec, Word2VecError, Word2VecOverlay, \
+    chain_version
 from word2vec.svc_config import SvcConfig
+from word2vec.admission import AdmissionController, AdmissionError
+from word2vec.lookup import SecondaryIndex, check_fallback_prefix
+from word2vec.compression import ResponseCompressor
 
 
 def _get_logger():
@@ -34,29 +40,80 @@ class JsonEncoder(json.JSONEncoder):
             return super(JsonEncoder, self).default(obj)
 
 
+# Everything a request reads from the model. A new ModelState is swapped in
+# with a single assignment on load or delta, and each request reads it once,
+# so a request never sees parts of two different models.
+ModelState = collections.namedtuple(
+    'ModelState', ['w2v', 'index', 'version', 'dim', 'mean_norm'])
+
+
 class Word2VecServer:
-    def __init__(self):
-        self.__w2v = None
-        self.__mean = None
-        self.__dim = None
-        self.__loading = True
+    def __init__(self, config=None):
+        self.__config = config if config is not None else \
+            SvcConfig.get_instance()
+        self.__admission = AdmissionController(
+            self.__config.max_inflight_words, self.__config.fast_lane_words,
+            self.__config.max_queued_requests, self.__config.queue_timeout,
+            self.__config.retry_after)
+        self.__compressor = ResponseCompressor(
+            self.__config.compression_min_size,
+            self.__config.compression_level, self.__config.zstd_level,
+            self.__config.compression_offload_size)
+        self.__state = None
         self.logger = _get_logger()
 
     def load(self, path):
         wv = Word2Vec(path=path)
         self.logger.info("Loading vectors...")
         time1 = time.time()
-        self.__w2v = wv.load_embeddings()
-        self.__loading = False
-        self.__dim = len(list(self.__w2v.values())[-1])
-        self.__mean = wv.get_mean_norm(self.__w2v)
+        embeddings = wv.load_embeddings()
+        if self.__config.prewarm_words > 0:
+            wv.prewarm(embeddings, self.__config.prewarm_words)
+        w2v = Word2VecOverlay(embeddings, wv.get_mean_norm(embeddings))
+        index = SecondaryIndex(self.__config.lookup_fallbacks)
+        index.build(w2v)
+        self.__state = ModelState(w2v, index, wv.digest[:16], w2v.dim,
+                                  w2v.mean_norm)
         time2 = time.time()
         self.logger.info(
             "Done loading vectors - took {}".format(time2 - time1))
 
+    @property
+    def version(self):
+        """
+        Identifies the model by content: a digest of the base file, chained
+        with a digest of each applied delta. Replicas that loaded the same
+        files report the same version, and row ids only change with it.
+        """
+        return self.__state.version
+
+    @property
+    def mean_norm(self):
+        return self.__state.mean_norm
+
+    def apply_delta(self, path):
+        """
+        Applies the delta to a copy of the model, and swaps the copy in once
+        it's complete, so requests still running on the executor carry on
+        with the model they started with.
+        """
+        wv = Word2Vec(path=path)
+        delta = wv.load_delta()
+        state = self.__state
+        w2v = state.w2v.copy()
+        w2v.apply_delta(delta)
+        index = state.index.with_words(
+            word for section in ('added', 'replaced')
+            for word in delta.get(section, {}))
+        version = chain_version(state.version, wv.digest)
+        self.__state = ModelState(w2v, index, version, w2v.dim, w2v.mean_norm)
+        self.logger.info("Applied delta {}, model version is now {}".format(
+            path, version))
+
     def gen_random_mean_norm_vector(self):
-        tmp = numpy.random.normal(size=self.__dim).astype(numpy.float64)
-        tmp /= numpy.linalg.norm(tmp) / self.__mean
+        state = self.__state
+        tmp = numpy.random.normal(size=state.dim).astype(numpy.float64)
+        tmp /= numpy.linalg.norm(tmp) / state.mean_norm
         return tmp
 
     async def handle_reload(self, request):
@@ -67,55 +124,299 @@ class Word2VecServer:
         self.load(path)
         return web.Response()
 
-    async def handle_request_multiple_words(self, request):
+    async def handle_apply_delta(self, request):
         """
-        This endpoint handles a request that takes a JSON array of words, and returns
-        a dictionary containing the vectorization of those words.
+        This endpoint layers a delta file over the loaded vectors.
         Example:
-        Request: {"words" : ["word1", "word2"]}
-        Assuming we have the vectorisation for word1 but not for word2
-        Response: {"vectors":{"word1":[...], "word2":null}}
+        Request: {"path": "/datasets/domain-words.delta.pkl"}
+        Response: {"version": "5f1c0e9a7b3d2c41"}
         """
-
         data = await request.json()
+        if 'path' not in data:
+            raise web.HTTPBadRequest()
+        try:
+            self.apply_delta(data['path'])
+        except Word2VecError as exc:
+            self.logger.warning("Failed to apply delta: {}".format(exc))
+            raise web.HTTPBadRequest(text=str(exc))
+        return web.json_response({'version': self.version})
+
+    def check_body_size(self, request):
+        max_body_size = self.__config.max_body_size
+        if request.content_length is not None and \
+                request.content_length > max_body_size:
+            self.__admission.counters['shed_body_too_large'] += 1
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=max_body_size, actual_size=request.content_length)
+
+    def check_num_words(self, num_words):
+        max_words = self.__config.max_words_per_request
+        if num_words > max_words:
+            self.__admission.counters['shed_too_many_words'] += 1
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=max_words,
+                actual_size=num_words,
+                text="Request has {} words, the limit is {}".format(
+                    num_words, max_words))
+
+    async def read_json(self, request):
+        """Reads a JSON request body, enforcing the body size limit"""
+        self.check_body_size(request)
+        try:
+            return await request.json()
+        except web.HTTPRequestEntityTooLarge:
+            # chunked bodies, or bodies that decompress past client_max_size
+            self.__admission.counters['shed_body_too_large'] += 1
+            raise
+
+    async def read_words_request(self, request):
+        """Reads a request with a 'words' array, enforcing the size limits"""
+        data = await self.read_json(request)
         if 'words' not in data:
             raise web.HTTPBadRequest()
-        words = data['words']
-        self.logger.info("Request for {} words".format(len(words)))
+        self.check_num_words(len(data['words']))
+        return data
+
+    async def run_admitted(self, request, num_words, func, *args):
+        """
+        Waits until there is capacity for num_words, then runs func(*args).
+        Raises 429 if the request is shed. Clients can set an X-Priority
+        header, higher values are admitted first when queued. Requests in
+        the fast lane run on the event loop, larger ones run in the default
+        executor so that they hold their budget while the work is done
+        without blocking other requests.
+        """
+        try:
+            priority = int(request.headers.get('X-Priority', 0))
+        except ValueError:
+            raise web.HTTPBadRequest(text="X-Priority must be an integer")
+        try:
+            async with self.__admission.admit(num_words, priority):
+                if num_words <= self.__config.fast_lane_words:
+                    return func(*args)
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(None, func, *args)
+        except AdmissionError as exc:
+            raise web.HTTPTooManyRequests(
+                headers={'Retry-After': str(exc.retry_after)},
+                text="Request shed: {}".format(exc.reason))
+
+    @property
+    def compressor(self):
+        return self.__compressor
+
+    async def handle_request_admission_stats(self, request):
+        return web.json_response(self.__admission.stats())
+
+    async def handle_request_compression_stats(self, request):
+        return web.json_response(self.__compressor.stats())
+
+    def get_vectors_json(self, state, words):
         wordvec_dict = {}
         try:
             for word in words:
-                vecs = self.__w2v.get(word)
+                vecs = state.w2v.get(word)
                 if vecs is not None:
                     wordvec_dict[word] = vecs
                 else:
                     self.logger.info("unknown word {}".format(word))
-            json_response = json.dumps({'vectors': wordvec_dict},
-                                       cls=JsonEncoder)
-            return web.json_response(body=json_response)
+            return json.dumps({'vectors': wordvec_dict}, cls=JsonEncoder)
         except Exception:
             self.logger.exception("Error obtaining the vectors")
             raise
 
+    async def handle_request_multiple_words(self, request):
+        """
+        This endpoint handles a request that takes a JSON array of words, and returns
+        a dictionary containing the vectorization of those words.
+        Example:
+        Request: {"words" : ["word1", "word2"]}
+        Assuming we have the vectorisation for word1 but not for word2
+        Response: {"vectors":{"word1":[...], "word2":null}}
+        """
+
+        data = await self.read_words_request(request)
+        words = data['words']
+        self.logger.info("Request for {} words".format(len(words)))
+        json_response = await self.run_admitted(
+            request, len(words), self.get_vectors_json, self.__state, words)
+        return web.json_response(text=json_response)
+
     async def handle_request_health(self, request):
         return web.Response(status=200)
 
+    def get_unknown_words_json(self, state, words):
+        try:
+            unk_words = [w for w in words if w not in state.w2v]
+            return json.dumps({'unk_words': unk_words}, cls=JsonEncoder)
+        except Exception:
+            self.logger.exception("Error obtaining unknown words")
+            raise
+
     async def handle_request_unknown_words(self, request):
-        data = await request.json()
-        if 'words' not in data:
-            raise web.HTTPBadRequest()
+        data = await self.read_words_request(request)
         words = data['words']
         self.logger.info("checking for unknown words from {} words".format(
             len(words)))
+        json_response = await self.run_admitted(
+            request, len(words), self.get_unknown_words_json, self.__state,
+            words)
+        return web.json_response(text=json_response)
+
+    def get_lookup_json(self, state, words, fallbacks):
         try:
-            unk_words = [w for w in words if w not in self.__w2v.keys()]
-            json_response = json.dumps({'unk_words': unk_words},
-                                       cls=JsonEncoder)
-            return web.json_response(body=json_response)
+            resolved = state.index.resolve(words, state.w2v, fallbacks)
+            wordvec_dict = {}
+            matches = {}
+            for word, (canonical, fallback) in resolved.items():
+                wordvec_dict[word] = state.w2v.get(canonical)
+                if fallback != 'exact':
+                    matches[word] = {'word': canonical, 'fallback': fallback}
+            unk_words = [w for w in words if w not in resolved]
+            return json.dumps(
+                {
+                    'vectors': wordvec_dict,
+                    'unk_words': unk_words,
+                    'matches': matches
+                },
+                cls=JsonEncoder)
         except Exception:
-            self.logger.exception("Error obtaining unknown words")
+            self.logger.exception("Error looking up words")
             raise
 
+    async def handle_request_lookup(self, request):
+        """
+        This endpoint resolves a batch of words in a single call, falling back
+        to normalised forms (lowercase, NFKC, accents stripped) for words that
+        aren't found as given. Fallbacks are applied cumulatively in the order
+        of the W2V_LOOKUP_FALLBACKS setting, and a request can stop after
+        fewer of them by passing a prefix of that order.
+        Example:
+        Request: {"words" : ["Word1", "word2"], "fallbacks": ["lower"]}
+        Assuming only the lowercase form of Word1 is known
+        Response: {"vectors": {"Word1": [...]}, "unk_words": ["word2"],
+                   "matches": {"Word1": {"word": "word1", "fallback": "lower"}}}
+        """
+        data = await self.read_words_request(request)
+        state = self.__state
+        words = data['words']
+        fallbacks = data.get('fallbacks')
+        if fallbacks is not None:
+            if not isinstance(fallbacks, list):
+                raise web.HTTPBadRequest(text="fallbacks must be a list")
+            try:
+                check_fallback_prefix(fallbacks, state.index.fallbacks)
+            except Word2VecError as exc:
+                raise web.HTTPBadRequest(text=str(exc))
+        self.logger.info("Lookup for {} words".format(len(words)))
+        json_response = await self.run_admitted(
+            request, len(words), self.get_lookup_json, state, words,
+            fallbacks)
+        return web.json_response(text=json_response)
+
+    def get_ids_json(self, state, words):
+        ids = {}
+        unk_words = []
+        for word in words:
+            word_id = state.w2v.word_id(word)
+            if word_id is not None:
+                ids[word] = word_id
+            else:
+                unk_words.append(word)
+        return json.dumps({
+            'version': state.version,
+            'ids': ids,
+            'unk_words': unk_words
+        })
+
+    async def handle_request_ids(self, request):
+        """
+        This endpoint maps words to their integer row ids, which stay the same
+        for a given model version.
+        Example:
+        Request: {"words" : ["word1", "word2"]}
+        Assuming we have the vectorisation for word1 but not for word2
+        Response: {"version": "5f1c0e9a7b3d2c41", "ids": {"word1": 1234},
+                   "unk_words": ["word2"]}
+        """
+        data = await self.read_words_request(request)
+        words = data['words']
+        self.logger.info("Request for ids of {} words".format(len(words)))
+        json_response = await self.run_admitted(
+            request, len(words), self.get_ids_json, self.__state, words)
+        return web.json_response(text=json_response)
+
+    def read_id_request(self, state, data):
+        if 'ids' in data:
+            ids = data['ids']
+            if not isinstance(ids, list) or not all(
+                    isinstance(i, int) for i in ids):
+                raise web.HTTPBadRequest(text="ids must be a list of integers")
+            return ids
+        if 'start' in data and 'end' in data:
+            start, end = data['start'], data['end']
+            if not isinstance(start, int) or not isinstance(end, int) or \
+                    start < 0 or end < start:
+                raise web.HTTPBadRequest(
+                    text="start and end must be integers with start <= end")
+            return range(start, min(end, state.w2v.num_ids))
+        raise web.HTTPBadRequest(text="Expected ids, or start and end")
+
+    def get_vectors_by_id(self, state, ids, binary):
+        words = [state.w2v.word_at(word_id) for word_id in ids]
+        if binary:
+            rows = numpy.full((len(ids), state.dim), numpy.nan, dtype='<f4')
+            for row, word in enumerate(words):
+                if word is not None:
+                    rows[row] = state.w2v.get(word)
+            return rows.tobytes()
+        vectors = [
+            state.w2v.get(word) if word is not None else None
+            for word in words
+        ]
+        return json.dumps(
+            {
+                'version': state.version,
+                'ids': list(ids),
+                'words': words,
+                'vectors': vectors
+            },
+            cls=JsonEncoder)
+
+    async def handle_request_vectors_by_id(self, request):
+        """
+        This endpoint gathers vectors by row id, from either a list of ids or
+        a contiguous range (end is exclusive). Ids without a word have null
+        vectors.
+        Example:
+        Request: {"ids": [1234, 99]} or {"start": 0, "end": 2}
+        Response: {"version": "5f1c0e9a7b3d2c41", "ids": [1234, 99],
+                   "words": ["word1", null], "vectors": [[...], null]}
+        With an 'Accept: application/octet-stream' header the response is the
+        vectors as consecutive little-endian float32 rows, with NaN rows for
+        ids without a word, and the model version, dimension and row count in
+        the X-Model-Version, X-Vector-Dim and X-Row-Count headers.
+        """
+        data = await self.read_json(request)
+        state = self.__state
+        ids = self.read_id_request(state, data)
+        self.check_num_words(len(ids))
+        binary = 'application/octet-stream' in request.headers.get(
+            'Accept', '')
+        self.logger.info("Request for {} vectors by id".format(len(ids)))
+        response = await self.run_admitted(
+            request, len(ids), self.get_vectors_by_id, state, ids, binary)
+        if binary:
+            return web.Response(
+                body=response,
+                content_type='application/octet-stream',
+                headers={
+                    'X-Model-Version': state.version,
+                    'X-Vector-Dim': str(state.dim),
+                    'X-Row-Count': str(len(ids))
+                })
+        return web.json_response(text=response)
+
 
 LOGGING_CONFIG_TEXT = """
 version: 1
@@ -156,10 +457,20 @@ async def log_error_middleware(request, handler):
 
 def initialize_web_app(app, w2v_server):
     app.middlewares.append(log_error_middleware)
+    app.middlewares.append(w2v_server.compressor.middleware())
     app.router.add_post('/words', w2v_server.handle_request_multiple_words)
     app.router.add_get('/health', w2v_server.handle_request_health)
     app.router.add_post('/unk_words', w2v_server.handle_request_unknown_words)
     app.router.add_post('/reload', w2v_server.handle_reload)
+    app.router.add_post('/apply_delta', w2v_server.handle_apply_delta)
+    app.router.add_post('/lookup', w2v_server.handle_request_lookup)
+    app.router.add_post('/ids', w2v_server.handle_request_ids)
+    app.router.add_post('/vectors_by_id',
+                        w2v_server.handle_request_vectors_by_id)
+    app.router.add_get('/admission_stats',
+                       w2v_server.handle_request_admission_stats)
+    app.router.add_get('/compression_stats',
+                       w2v_server.handle_request_compression_stats)
 
 
 class W2vLogFilter(logging.Filter):
@@ -190,10 +501,10 @@ def main():
     logging.config.dictConfig(logging_config)
 
     config = SvcConfig.get_instance()
-    server = Word2VecServer()
+    server = Word2VecServer(config)
     server.load(config.vectors_file)
 
-    app = web.Application()
+    app = web.Application(client_max_size=config.max_body_size)
     initialize_web_app(app, server)
     web.run_app(app, port=config.server_port)
 
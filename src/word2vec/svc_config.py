@@ -9,6 +9,27 @@ class SvcConfig(object):
         self._vectors_file = os.environ.get(
             'W2V_VECTOR_FILE', '/datasets/glove.840B.300d.pkl')
         self._server_port = os.environ.get('W2V_SERVER_PORT', '9090')
+        self._max_words_per_request = os.environ.get(
+            'W2V_MAX_WORDS_PER_REQUEST', '100000')
+        self._max_inflight_words = os.environ.get('W2V_MAX_INFLIGHT_WORDS',
+                                                  '200000')
+        self._max_body_size = os.environ.get('W2V_MAX_BODY_SIZE',
+                                             str(16 * 1024 * 1024))
+        self._fast_lane_words = os.environ.get('W2V_FAST_LANE_WORDS', '100')
+        self._max_queued_requests = os.environ.get(
+            'W2V_MAX_QUEUED_REQUESTS', '32')
+        self._queue_timeout = os.environ.get('W2V_QUEUE_TIMEOUT', '5')
+        self._retry_after = os.environ.get('W2V_RETRY_AFTER', '1')
+        self._prewarm_words = os.environ.get('W2V_PREWARM_WORDS', '100000')
+        self._lookup_fallbacks = os.environ.get('W2V_LOOKUP_FALLBACKS',
+                                                'lower,nfkc,unaccent')
+        self._compression_min_size = os.environ.get(
+            'W2V_COMPRESSION_MIN_SIZE', '1024')
+        self._compression_level = os.environ.get('W2V_COMPRESSION_LEVEL',
+                                                 '1')
+        self._zstd_level = os.environ.get('W2V_ZSTD_LEVEL', '3')
+        self._compression_offload_size = os.environ.get(
+            'W2V_COMPRESSION_OFFLOAD_SIZE', str(256 * 1024))
 
     @staticmethod
     def get_instance():
@@ -23,3 +44,57 @@ class SvcConfig(object):
     @property
     def server_port(self):
         return int(self._server_port)
+
+    @property
+    def max_words_per_request(self):
+        return int(self._max_words_per_request)
+
+    @property
+    def max_inflight_words(self):
+        return int(self._max_inflight_words)
+
+    @property
+    def max_body_size(self):
+        return int(self._max_body_size)
+
+    @property
+    def fast_lane_words(self):
+        return int(self._fast_lane_words)
+
+    @property
+    def max_queued_requests(self):
+        return int(self._max_queued_requests)
+
+    @property
+    def queue_timeout(self):
+        return float(self._queue_timeout)
+
+    @property
+    def retry_after(self):
+        return int(self._retry_after)
+
+    @property
+    def prewarm_words(self):
+        return int(self._prewarm_words)
+
+    @property
+    def lookup_fallbacks(self):
+        return [
+            f.strip() for f in self._lookup_fallbacks.split(',') if f.strip()
+        ]
+
+    @property
+    def compression_min_size(self):
+        return int(self._compression_min_size)
+
+    @property
+    def compression_level(self):
+        return int(self._compression_level)
+
+    @property
+    def zstd_level(self):
+        return int(self._zstd_level)
+
+    @property
+    def compression_offload_size(self):
+        return int(self._compression_offload_size)
@@ -5,6 +5,9 @@ import numpy as np
 import logging
 import pickle
 from pathlib import Path
+import mmap
+import hashlib
+from collections.abc import Mapping
 
 
 def _get_logger():
@@ -16,13 +19,34 @@ class Word2VecError(Exception):
     pass
 
 
+def file_digest(*paths):
+    """Returns a hex digest of the contents of the files"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chain_version(version, delta_digest):
+    """Returns the model version after applying a delta to version"""
+    return hashlib.sha256('{}:{}'.format(version, delta_digest).encode(
+        'utf8')).hexdigest()[:16]
+
+
 class Word2Vec(object):
 
     PICKLED_VECTORS_FILE_EXT = ".pkl"
+    MATRIX_FILE_EXT = ".npy"
+    MATRIX_VOCAB_FILE_EXT = ".vocab"
+    DELTA_SECTIONS = ('added', 'replaced', 'removed')
 
     def __init__(self, path=None):
         self.__logger = _get_logger()
         self.path = path
+        # content digest of the last file loaded, which identifies the model
+        self.digest = None
         self.use = 'glove' if 'glove' in self.path else 'w2v'
 
     @property
@@ -30,26 +54,103 @@ class Word2Vec(object):
         return self.__logger
 
     def get_mean_norm(self, w2v):
+        if isinstance(w2v, VectorMatrix):
+            # calculated when the matrix was written, so that loading doesn't
+            # page in the whole file
+            return w2v.mean_norm
         mean_norm = np.mean(
             np.linalg.norm(np.array(list(w2v.values())), axis=1))
         return mean_norm
 
+    def prewarm(self, embeddings, num_words):
+        """
+        Pages in the first num_words rows of a memory-mapped matrix before
+        serving. Matrices written by reorder_data.py keep the most frequently
+        used words first, so this is the hot region. Pickled embeddings are
+        already in memory once loaded, so there is nothing to do for them.
+        """
+        if not isinstance(embeddings, VectorMatrix) or \
+                not isinstance(embeddings.rows, np.memmap):
+            return 0
+        tStart = time()
+        hot = embeddings.rows[:num_words]
+        mapped = getattr(embeddings.rows, '_mmap', None)
+        if mapped is not None and hasattr(mapped, 'madvise') and \
+                hasattr(mmap, 'MADV_WILLNEED'):
+            offset = embeddings.rows.offset
+            start = offset - offset % mmap.PAGESIZE
+            mapped.madvise(mmap.MADV_WILLNEED, start,
+                           offset + hot.nbytes - start)
+        # read one value from every page, so the rows are resident even where
+        # madvise isn't available
+        rows_per_page = max(1, mmap.PAGESIZE // hot.strides[0])
+        hot[::rows_per_page, 0].sum()
+        self.logger.info("Prewarmed {} vectors: {} secs".format(
+            len(hot),
+            time() - tStart))
+        return len(hot)
+
+    def load_matrix(self, matrix_path, vocab_path):
+        """
+        Memory-maps a matrix written by reorder_data.py, with its vocabulary
+        file holding the words in row order and the mean norm.
+        """
+        tStart = time()
+        with vocab_path.open('rb') as vocab_file:
+            vocab = pickle.load(vocab_file)
+        matrix = np.load(str(matrix_path), mmap_mode='r')
+        if len(vocab['words']) != len(matrix):
+            raise Word2VecError(
+                "{} has {} words but {} has {} rows".format(
+                    vocab_path, len(vocab['words']), matrix_path,
+                    len(matrix)))
+        self.logger.info(
+            "Finished mapping embeddings matrix: {} mins".format(
+                (time() - tStart) / 60.))
+        # the vocabulary file holds the row order, and a checksum of the
+        # matrix when written by reorder_data.py
+        if 'checksum' in vocab:
+            self.digest = file_digest(vocab_path)
+        else:
+            self.digest = file_digest(vocab_path, matrix_path)
+        return VectorMatrix(vocab['words'], matrix, vocab['mean_norm'])
+
     def load_embeddings(self, vocab=None):
         """
         Reads word embeddings from disk.
         """
 
-        # First try to load a pickle file, if it exists, in the same directory as
-        # the vectors file
+        # Prefer a memory-mapped matrix written by reorder_data.py, then a
+        # pickle file, in the same directory as the vectors file
         local_path = Path(self.path)
+        matrix_path = local_path.with_suffix(self.MATRIX_FILE_EXT)
+        vocab_path = local_path.with_suffix(self.MATRIX_VOCAB_FILE_EXT)
         pickled_vectors_file_path = local_path.with_suffix(
             self.PICKLED_VECTORS_FILE_EXT)
+        if matrix_path.exists() and vocab_path.exists():
+            self.logger.info("found embeddings matrix at {}".format(
+                str(matrix_path)))
+            if pickled_vectors_file_path.exists() and \
+                    pickled_vectors_file_path.stat().st_mtime > \
+                    matrix_path.stat().st_mtime:
+                self.logger.warning(
+                    "{} is newer than {}, the matrix may be out of date. "
+                    "Regenerate it with reorder_data.py".format(
+                        pickled_vectors_file_path, matrix_path))
+            return self.load_matrix(matrix_path, vocab_path)
+
         if pickled_vectors_file_path.exists():
             self.logger.info("found pickled file for embeddings at {}".format(
                 str(pickled_vectors_file_path)))
             tStart = time()
             with pickled_vectors_file_path.open('rb') as pkl_file:
                 embeddings = pickle.load(pkl_file)
+            self.digest = file_digest(pickled_vectors_file_path)
+            # keep the vectors in file order, which gives their row ids,
+            # and let the dictionary go
+            embeddings = VectorMatrix(
+                list(embeddings), list(embeddings.values()),
+                self.get_mean_norm(embeddings))
             self.logger.info(
                 "Finished loading embeddings from pickle: {} mins".format(
                     (time() - tStart) / 60.))
@@ -58,3 +159,225 @@ class Word2Vec(object):
                                 format(pickled_vectors_file_path))
 
         return embeddings
+
+    def load_delta(self):
+        """
+        Reads a delta file from disk. A delta is a pickled dictionary with
+        'added' and 'replaced' mapping words to vectors, and 'removed'
+        holding a list of words.
+        """
+        delta_path = Path(self.path)
+        if not delta_path.exists():
+            raise Word2VecError(
+                "Couldn't find delta file at {}".format(delta_path))
+        try:
+            with delta_path.open('rb') as pkl_file:
+                delta = pickle.load(pkl_file)
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, IndexError, TypeError, ValueError) as exc:
+            raise Word2VecError("Couldn't read delta file {}: {}".format(
+                delta_path, exc))
+
+        if not isinstance(delta, dict):
+            raise Word2VecError("Delta file {} is not a dictionary".format(
+                delta_path))
+        unknown_sections = set(delta.keys()) - set(self.DELTA_SECTIONS)
+        if unknown_sections:
+            raise Word2VecError("Unknown sections {} in delta file {}".format(
+                sorted(unknown_sections), delta_path))
+        for section in ('added', 'replaced'):
+            if not isinstance(delta.get(section, {}), dict):
+                raise Word2VecError(
+                    "Section '{}' in delta file {} is not a dictionary".format(
+                        section, delta_path))
+        if not isinstance(delta.get('removed', []), list):
+            raise Word2VecError(
+                "Section 'removed' in delta file {} is not a list".format(
+                    delta_path))
+        self.logger.info("loaded delta {}: {}".format(
+            delta_path, {k: len(v)
+                         for k, v in delta.items()}))
+        self.digest = file_digest(delta_path)
+        return delta
+
+
+class VectorMatrix(Mapping):
+    """
+    Read-only mapping of words to rows, in row order. The rows are a
+    contiguous matrix, usually memory-mapped, or a list of vectors loaded
+    from a pickle file.
+    """
+
+    def __init__(self, words, rows, mean_norm):
+        self.__words = words
+        self.__rows = {word: i for i, word in enumerate(words)}
+        self.rows = rows
+        self.mean_norm = mean_norm
+
+    def row_of(self, word):
+        """Returns the row of word, or None if it isn't in the matrix"""
+        return self.__rows.get(word)
+
+    def word_at(self, row):
+        """Returns the word for a row, which must be in range"""
+        return self.__words[row]
+
+    def __getitem__(self, word):
+        return self.rows[self.__rows[word]]
+
+    def get(self, word, default=None):
+        row = self.__rows.get(word)
+        if row is None:
+            return default
+        return self.rows[row]
+
+    def __contains__(self, word):
+        return word in self.__rows
+
+    def __iter__(self):
+        return iter(self.__words)
+
+    def __len__(self):
+        return len(self.__words)
+
+
+class Word2VecOverlay(Mapping):
+    """
+    Layers deltas over a base VectorMatrix. Lookups check the
+    small overlay before the base, so the base is never copied or modified.
+    The mean norm is kept up to date incrementally as deltas are applied.
+
+    Every word also has an integer row id: base words use their row in the
+    base, and words added by deltas are numbered after them. Ids are never
+    reused, so a removed word leaves a gap.
+    """
+
+    def __init__(self, base, mean_norm):
+        self.__base = base
+        self.__overlay = {}
+        self.__removed = set()
+        self.__size = len(base)
+        self.__norm_total = float(mean_norm) * self.__size
+        self.__dim = len(next(iter(base.values()))) if base else None
+        # ids of words added by deltas, base ids come from the base rows
+        self.__added_words = []
+        self.__added_ids = {}
+
+    @property
+    def dim(self):
+        return self.__dim
+
+    def copy(self):
+        """
+        Returns an overlay sharing the base, with its own copy of the
+        changes, so a delta can be applied to it while this one is in use.
+        """
+        other = Word2VecOverlay.__new__(Word2VecOverlay)
+        other.__base = self.__base
+        other.__overlay = dict(self.__overlay)
+        other.__removed = set(self.__removed)
+        other.__size = self.__size
+        other.__norm_total = self.__norm_total
+        other.__dim = self.__dim
+        other.__added_words = list(self.__added_words)
+        other.__added_ids = dict(self.__added_ids)
+        return other
+
+    @property
+    def mean_norm(self):
+        if self.__size == 0:
+            return 0.0
+        return self.__norm_total / self.__size
+
+    @property
+    def num_ids(self):
+        """One past the highest row id"""
+        return len(self.__base) + len(self.__added_words)
+
+    def word_id(self, word):
+        """Returns the row id of word, or None if it isn't in the vocabulary"""
+        if word not in self:
+            return None
+        row = self.__base.row_of(word)
+        if row is not None:
+            return row
+        return self.__added_ids[word]
+
+    def word_at(self, word_id):
+        """Returns the word for a row id, or None if there isn't one"""
+        num_base = len(self.__base)
+        if 0 <= word_id < num_base:
+            word = self.__base.word_at(word_id)
+        elif num_base <= word_id < self.num_ids:
+            word = self.__added_words[word_id - num_base]
+        else:
+            return None
+        return word if word in self else None
+
+    def __getitem__(self, word):
+        vec = self.get(word)
+        if vec is None:
+            raise KeyError(word)
+        return vec
+
+    def get(self, word, default=None):
+        vec = self.__overlay.get(word)
+        if vec is not None:
+            return vec
+        if word in self.__removed:
+            return default
+        return self.__base.get(word, default)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __iter__(self):
+        for word in self.__base:
+            if word not in self.__removed and word not in self.__overlay:
+                yield word
+        yield from self.__overlay
+
+    def __len__(self):
+        return self.__size
+
+    def apply_delta(self, delta):
+        """Applies a delta loaded by Word2Vec.load_delta"""
+        updates = {}
+        for section in ('added', 'replaced'):
+            for word, vec in delta.get(section, {}).items():
+                vec = np.asarray(vec, dtype=np.float32)
+                if self.__dim is not None and vec.shape != (self.__dim, ):
+                    raise Word2VecError(
+                        "Vector for '{}' has shape {}, expected ({},)".format(
+                            word, vec.shape, self.__dim))
+                updates[word] = vec
+
+        for word in delta.get('removed', []):
+            self.__remove(word)
+        for word, vec in updates.items():
+            self.__set(word, vec)
+
+    def __remove(self, word):
+        old_vec = self.get(word)
+        if old_vec is None:
+            return
+        self.__norm_total -= float(np.linalg.norm(old_vec))
+        self.__size -= 1
+        self.__overlay.pop(word, None)
+        if word in self.__base:
+            self.__removed.add(word)
+
+    def __set(self, word, vec):
+        old_vec = self.get(word)
+        if old_vec is None:
+            self.__size += 1
+        else:
+            self.__norm_total -= float(np.linalg.norm(old_vec))
+        self.__norm_total += float(np.linalg.norm(vec))
+        self.__overlay[word] = vec
+        self.__removed.discard(word)
+        if word not in self.__base and word not in self.__added_ids:
+            self.__added_ids[word] = self.num_ids
+            self.__added_words.append(word)
+        if self.__dim is None:
+            self.__dim = len(vec)